@@ -1,59 +1,248 @@
 import streamlit as st
 import pandas as pd
-import difflib
+import numpy as np
 import re
 import io
+from rapidfuzz import fuzz, process
 
 st.set_page_config(page_title="UPS Australia Matching Tool", layout="wide")
 
 # ---------- Normalization Helper ----------
-def normalize_name(name):
-    if pd.isna(name):
-        return ''
-    name = str(name).upper()
-    name = re.sub(r'[^A-Z0-9 ]', '', name)  # Remove punctuation
-    name = re.sub(r'\b(AUSTRALIA|AUST|PTY|P/L|LTD|LIMITED|CORPORATION|INC|PTE|CO|THE|AND|&)\b', '', name)
-    name = re.sub(r'\s+', ' ', name).strip()
-    return name
-
-# ---------- Matching Function with improved personal name heuristic ----------
-def match_recipient_to_account(recipient_name, acc_df, threshold):
-    normalized_recipient = normalize_name(recipient_name)
-
-    acc_df['Normalized Name'] = acc_df['Customer Name'].apply(normalize_name)
-
-    # Compute similarity scores
-    acc_df['Similarity'] = acc_df['Normalized Name'].apply(
-        lambda x: difflib.SequenceMatcher(None, normalized_recipient, x).ratio()
+# Compiled once at import; normalize_names runs over every recipient and account
+PUNCT_RE = re.compile(r'[^A-Z0-9 ]')
+COMPANY_WORDS_RE = re.compile(r'\b(AUSTRALIA|AUST|PTY|P/L|LTD|LIMITED|CORPORATION|INC|PTE|CO|THE|AND|&)\b')
+WHITESPACE_RE = re.compile(r'\s+')
+
+def normalize_names(names):
+    # Shipment and account files repeat the same company names many times, so only
+    # the distinct names are normalized, each step one vectorized pandas string pass.
+    # codes broadcast the results back, with -1 (missing names) mapping to ''.
+    codes, uniques = pd.factorize(names)
+    normalized = pd.Series(uniques, dtype=object).astype(str).str.upper()
+    normalized = normalized.str.replace(PUNCT_RE, '', regex=True)  # Remove punctuation
+    normalized = normalized.str.replace(COMPANY_WORDS_RE, '', regex=True)
+    normalized = normalized.str.replace(WHITESPACE_RE, ' ', regex=True).str.strip()
+    normalized = np.append(normalized.to_numpy(dtype=object), '')
+    return pd.Series(normalized[codes], index=names.index, dtype=object)
+
+# ---------- Batch Scoring ----------
+# Scores are whole percentages (0-100) stored as uint8: an eighth of the
+# memory of float64 for the per-chunk score blocks and everything after them
+TOP_N = 3
+SCORE_CHUNK_SIZE = 4096  # recipients per cdist call; bounds the score block to chunk x N
+
+def top_n_columns(scores):
+    # A partition finds each row's TOP_N-th best score in O(N) instead of a full sort.
+    # Columns above it are kept, plus the earliest columns tied with it, so the pick
+    # matches a stable sort; only those few are then ordered, ties by account order.
+    # Besides the partitioned copy, which is freed once kth is taken, the only
+    # temporaries the size of the score block are the two bool masks keep and tied.
+    n_accounts = scores.shape[1]
+    if n_accounts > TOP_N:
+        # copy() so the partitioned block itself can be freed straight away
+        kth = np.partition(scores, n_accounts - TOP_N, axis=1)[:, n_accounts - TOP_N, None].copy()
+        keep = scores > kth
+        tied = scores == kth
+        slots = TOP_N - keep.sum(axis=1)
+
+        # Fill the remaining slots with the earliest tied columns, one argmax pass per
+        # slot (at most TOP_N passes); rows whose slots are all filled are left alone
+        for _ in range(TOP_N):
+            pending = np.nonzero(slots)[0]
+            if not len(pending):
+                break
+            first = tied.argmax(axis=1)[pending]
+            keep[pending, first] = True
+            tied[pending, first] = False
+            slots[pending] -= 1
+        idx = np.nonzero(keep)[1].reshape(len(scores), TOP_N)
+    else:
+        idx = np.broadcast_to(np.arange(n_accounts), scores.shape)
+    best = np.take_along_axis(scores, idx, axis=1)
+    # Widen before negating: -best on uint8 would wrap around
+    order = np.lexsort((idx, -best.astype(np.int16)), axis=1)
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(best, order, axis=1)
+
+def score_recipients(normalized_recipients, normalized_accounts):
+    # Returns the TOP_N best account indices and scores per recipient, best first.
+    # Recipients are scored in chunks so the full M x N matrix never exists at once;
+    # workers=-1 lets cdist spread each chunk over all cores (it releases the GIL).
+    top_idx, top_scores = [], []
+    for start in range(0, len(normalized_recipients), SCORE_CHUNK_SIZE):
+        scores = process.cdist(
+            normalized_recipients[start:start + SCORE_CHUNK_SIZE], normalized_accounts,
+            scorer=fuzz.ratio, dtype=np.uint8, workers=-1
+        )
+        idx, best = top_n_columns(scores)
+        top_idx.append(idx)
+        top_scores.append(best)
+
+    if not top_idx:
+        width = min(TOP_N, len(normalized_accounts))
+        return np.empty((0, width), dtype=np.intp), np.empty((0, width), dtype=np.uint8)
+    return np.concatenate(top_idx), np.concatenate(top_scores)
+
+# ---------- Personal Name Heuristic ----------
+COMPANY_INDICATORS = ['PTY', 'LTD', 'P/L', 'LABS', 'LABORATORIES', 'CORPORATION', 'INC', 'CO']
+COMPANY_INDICATOR_RE = re.compile('|'.join(map(re.escape, COMPANY_INDICATORS)))
+
+def personal_name_mask(recipient_names, normalized_recipients):
+    # At most one normalized word and no company indicator anywhere in the raw name.
+    # Normalized names are whitespace-collapsed, so a single word has no spaces.
+    upper = recipient_names.fillna('').astype(str).str.upper()
+    has_indicator = upper.str.contains(COMPANY_INDICATOR_RE, regex=True).to_numpy(dtype=bool)
+    single_word = normalized_recipients.str.count(' ').to_numpy() == 0
+    return single_word & ~has_indicator
+
+# ---------- Matching with improved personal name heuristic ----------
+def first_two_words(normalized_names):
+    return normalized_names.str.split().str[:2].str.join(' ')
+
+def join_suggestions(top_names):
+    # Comma-join each row's suggested names, skipping blanks (loops over the 3 columns, not the rows)
+    suggestions = pd.Series('', index=range(len(top_names)), dtype=object)
+    for j in range(top_names.shape[1]):
+        names = pd.Series(top_names[:, j])
+        present = names.notna()
+        names = names.where(present, '').astype(str)
+        sep = np.where(present & (suggestions != ''), ', ', '').astype(object)
+        suggestions = suggestions + sep + names
+    return suggestions.to_numpy()
+
+# Everything except ship_df and threshold comes precomputed from score_uploads:
+# exact_idx / recipient_words have one row per distinct normalized recipient,
+# top_idx / top_scores one row per distinct recipient that was fuzzy-scored
+# (exact_idx < 0), recipient_codes gives each shipment row's index into the
+# distinct recipients, and personal is the per-row personal_name_mask
+def build_results(ship_df, acc_df, recipient_codes, recipient_words, personal, exact_idx, top_idx, top_scores, threshold):
+    if top_idx.shape[1] == 0:
+        # Empty account sheet: one all-NaN placeholder account at score 0, which never
+        # clears the threshold, keeps the indexing below well-defined
+        acc_df = acc_df.reindex([0]).astype(object)
+        top_idx = np.zeros((len(top_idx), 1), dtype=np.intp)
+        top_scores = np.zeros((len(top_scores), 1), dtype=np.uint8)
+
+    # Exact rows take their single account at 100; the other rows are filled in from
+    # the fuzzy top matches below
+    fuzzy_positions = np.cumsum(exact_idx < 0) - 1
+    best_idx = exact_idx[recipient_codes]
+    exact = best_idx >= 0
+    fuzzy = ~exact
+    fuzzy_codes = recipient_codes[fuzzy]
+    scores = np.full(len(recipient_codes), 100, dtype=np.uint8)
+    n_high = np.zeros(len(recipient_codes), dtype=np.intp)
+    use_word_match = np.zeros(len(recipient_codes), dtype=bool)
+
+    # Expand the per-recipient top matches to every fuzzy shipment row
+    top_idx, top_scores = top_idx[fuzzy_positions[fuzzy_codes]], top_scores[fuzzy_positions[fuzzy_codes]]
+    rows = np.arange(len(top_idx))
+    # The slider is 0-1 in steps of 0.01; scores are whole percentages, rounded half up
+    # by cdist, so a raw score of 79.5 already counts as 80 and passes 0.80
+    high_conf = top_scores >= round(threshold * 100)  # always a prefix of each row, since scores are sorted
+    n_high[fuzzy] = high_conf.sum(axis=1)
+
+    # With several high-confidence matches, prefer the first whose first two words agree
+    acc_words = acc_df['First Two Words'].to_numpy()
+    word_match = high_conf & (acc_words[top_idx] == recipient_words[fuzzy_codes][:, None])
+    use_word_match[fuzzy] = (n_high[fuzzy] > 1) & word_match.any(axis=1)
+    best_col = np.where(use_word_match[fuzzy], word_match.argmax(axis=1), 0)
+    best_idx[fuzzy] = top_idx[rows, best_col]
+    scores[fuzzy] = top_scores[rows, best_col]
+
+    matched = exact | (n_high > 0)
+    personal = ~matched & personal
+
+    comments = np.select(
+        [exact, n_high == 1, use_word_match, n_high > 1, personal],
+        ["✅ Exact name match", "✅ One strong match", "✅ First-two-word match", "⚠ Multiple close matches",
+         "👤 Treated as personal name"],
+        default="❌ No good match"
     )
 
-    sorted_matches = acc_df.sort_values(by='Similarity', ascending=False)
-    top_matches = sorted_matches.head(3)
+    account_numbers = acc_df['Account Number'].to_numpy(dtype=object)
+    customer_names = acc_df['Customer Name'].to_numpy(dtype=object)
+    # An exact row's only suggestion is its account; fuzzy rows list their top matches
+    suggestions = np.empty(len(recipient_codes), dtype=object)
+    suggestions[exact] = customer_names[best_idx[exact]].astype(str)
+    suggestions[fuzzy] = join_suggestions(customer_names[top_idx])
+
+    return pd.DataFrame({
+        'Tracking Number': ship_df['Tracking Number'].to_numpy() if 'Tracking Number' in ship_df.columns else '',
+        'Recipient Company Name': ship_df['Recipient Company Name'].to_numpy(),
+        'Matched Account': np.where(matched, account_numbers[best_idx], 'Cash'),
+        'Similarity Score': np.where(matched, scores, 0) / 100,
+        'Suggestions': np.where(personal, '', suggestions),
+        'Match Notes': comments
+    })
+
+# ---------- Input Columns ----------
+# Only these columns are read; 'Tracking Number' is optional in the shipment file
+SHIPMENT_COLUMNS = ['Tracking Number', 'Recipient Company Name']
+ACCOUNT_COLUMNS = ['Customer Name', 'Account Number']
+
+# ---------- Cached Loading & Scoring ----------
+# Keyed by the uploaded bytes, so Streamlit reruns (e.g. moving the threshold
+# slider) skip re-reading, re-normalizing and re-scoring unchanged files.
+# The caches live in the server process and are shared by every session, so
+# only the most recent uploads are kept, and nothing longer than CACHE_TTL.
+CACHE_MAX_UPLOADS = 4  # shipment/account file pairs
+CACHE_TTL = 3600  # seconds
 
-    high_conf_matches = top_matches[top_matches['Similarity'] >= threshold]
+@st.cache_data(show_spinner=False, max_entries=2 * CACHE_MAX_UPLOADS, ttl=CACHE_TTL)
+def read_upload(file_bytes, columns):
+    # calamine parses the workbook natively; dtype=str keeps account and
+    # tracking numbers as text (no lost leading zeros)
+    return pd.read_excel(io.BytesIO(file_bytes), usecols=lambda col: col in columns, dtype=str, engine='calamine')
 
-    if len(high_conf_matches) == 1:
-        best_match = high_conf_matches.iloc[0]
-        return best_match['Account Number'], best_match['Similarity'], list(top_matches['Customer Name']), "✅ One strong match"
-    
-    elif len(high_conf_matches) > 1:
-        # Check if first two words match
-        rec_words = normalized_recipient.split()[:2]
-        for _, row in high_conf_matches.iterrows():
-            acc_words = row['Normalized Name'].split()[:2]
-            if rec_words == acc_words:
-                return row['Account Number'], row['Similarity'], list(top_matches['Customer Name']), "✅ First-two-word match"
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_UPLOADS, ttl=CACHE_TTL)
+def score_uploads(ship_bytes, acc_bytes):
+    ship_df = read_upload(ship_bytes, SHIPMENT_COLUMNS)
+    acc_df = read_upload(acc_bytes, ACCOUNT_COLUMNS)
 
-        best_match = high_conf_matches.iloc[0]
-        return best_match['Account Number'], best_match['Similarity'], list(top_matches['Customer Name']), "⚠ Multiple close matches"
+    # Repeated customer names are stored once as categories; the cached frame is
+    # copied back out of the cache on every rerun, so this keeps that copy small
+    acc_df['Customer Name'] = acc_df['Customer Name'].astype('category')
 
-    # Improved personal name heuristic:
-    company_indicators = ['PTY', 'LTD', 'P/L', 'LABS', 'LABORATORIES', 'CORPORATION', 'INC', 'CO']
-    if (len(normalized_recipient.split()) <= 1 and 
-        not any(indicator in recipient_name.upper() for indicator in company_indicators)):
-        return "Cash", 0, [], "👤 Treated as personal name"
+    # Normalize account names once, not once per shipment row
+    acc_df['Normalized Name'] = normalize_names(acc_df['Customer Name'])
+    acc_df['First Two Words'] = first_two_words(acc_df['Normalized Name']).to_numpy(dtype=object)
 
-    return "Cash", 0, list(top_matches['Customer Name']), "❌ No good match"
+    # Score every distinct recipient against every account in a single batch;
+    # recipient_codes maps each shipment row back to its row of the results.
+    # rapidfuzz gets plain lists rather than iterating over pandas Series.
+    normalized_recipients = normalize_names(ship_df['Recipient Company Name'])
+    recipient_codes, unique_recipients = pd.factorize(normalized_recipients)
+    normalized_accounts = acc_df['Normalized Name'].to_numpy().tolist()
+
+    # Recipients whose normalized name belongs to exactly one account skip fuzzy scoring:
+    # exact_idx holds that account (-1 otherwise), which build_results reports as an
+    # exact match at 100. A name shared by several accounts is ambiguous, so it goes
+    # through the scorer and every owner shows up in the suggestions; empty names are
+    # left to the scorer too, as before.
+    account_names = pd.Series(normalized_accounts, dtype=object)
+    single_owner = account_names.map(account_names.value_counts()).eq(1) & account_names.ne('')
+    exact_lookup = dict(zip(account_names[single_owner], account_names.index[single_owner]))
+    exact_idx = pd.Series(unique_recipients, dtype=object).map(exact_lookup).fillna(-1).to_numpy(dtype=np.intp)
+    top_idx, top_scores = score_recipients(unique_recipients[exact_idx < 0].tolist(), normalized_accounts)
+
+    # The threshold-independent parts of build_results are precomputed here too
+    recipient_words = first_two_words(pd.Series(unique_recipients, dtype=object)).to_numpy(dtype=object)
+    personal = personal_name_mask(ship_df['Recipient Company Name'], normalized_recipients)
+    return acc_df, recipient_codes, recipient_words, personal, exact_idx, top_idx, top_scores
+
+# ---------- Download Helper ----------
+# Cached on the inputs the result frame is built from, so reruns that leave them
+# unchanged don't serialize the workbook again. The frame itself is not hashed
+# (Streamlit skips parameters starting with an underscore): large frames are only
+# hashed from a sample of rows, which could serve a stale workbook after a slider
+# move. Each threshold value is its own entry, so the cache is bounded like the
+# upload caches above.
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_UPLOADS, ttl=CACHE_TTL)
+def convert_df(_df, ship_bytes, acc_bytes, threshold):
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        _df.to_excel(writer, index=False)
+    return output.getvalue()
 
 # ---------- UI ----------
 st.title("🇦🇺 UPS AU Recipient Name Matching Tool")
@@ -65,40 +254,27 @@ threshold = st.slider("🔧 Similarity Threshold", 0.5, 1.0, 0.8, 0.01)
 
 if uploaded_shipment and uploaded_accounts:
     try:
-        ship_df = pd.read_excel(uploaded_shipment)
-        acc_df = pd.read_excel(uploaded_accounts)
+        ship_bytes = uploaded_shipment.getvalue()
+        acc_bytes = uploaded_accounts.getvalue()
+        ship_df = read_upload(ship_bytes, SHIPMENT_COLUMNS)
+        acc_df = read_upload(acc_bytes, ACCOUNT_COLUMNS)
 
-        if 'Recipient Company Name' not in ship_df.columns or 'Customer Name' not in acc_df.columns:
-            st.error("❌ Required columns missing. Make sure files have 'Recipient Company Name' and 'Customer Name'.")
+        if 'Recipient Company Name' not in ship_df.columns or any(col not in acc_df.columns for col in ACCOUNT_COLUMNS):
+            st.error("❌ Required columns missing. Make sure files have 'Recipient Company Name', 'Customer Name' and 'Account Number'.")
         else:
-            results = []
-            for _, row in ship_df.iterrows():
-                acct, score, suggestions, comment = match_recipient_to_account(
-                    row['Recipient Company Name'], acc_df, threshold
-                )
-                results.append({
-                    'Tracking Number': row.get('Tracking Number', ''),
-                    'Recipient Company Name': row['Recipient Company Name'],
-                    'Matched Account': acct,
-                    'Similarity Score': round(score, 3),
-                    'Suggestions': ', '.join(str(s) for s in suggestions if pd.notna(s)),
-                    'Match Notes': comment
-                })
-
-            result_df = pd.DataFrame(results)
+            # Only the threshold-dependent step runs on every rerun
+            acc_df, recipient_codes, recipient_words, personal, exact_idx, top_idx, top_scores = score_uploads(
+                ship_bytes, acc_bytes
+            )
+            result_df = build_results(
+                ship_df, acc_df, recipient_codes, recipient_words, personal, exact_idx, top_idx, top_scores, threshold
+            )
             st.success("✅ Matching complete. Preview below:")
             st.dataframe(result_df, use_container_width=True)
 
-            # Download helper
-            def convert_df(df):
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    df.to_excel(writer, index=False)
-                return output.getvalue()
-
             st.download_button(
                 label="📥 Download Matching Result",
-                data=convert_df(result_df),
+                data=convert_df(result_df, ship_bytes, acc_bytes, threshold),
                 file_name="matching_result.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             )